@@ -0,0 +1,75 @@
+import asyncio
+import logging
+from typing import Dict, List, Tuple
+
+from aiogram import Bot, Dispatcher, types
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 100  # максимум, который отдает getUpdates
+CONCURRENCY = 20  # сколько групп обновлений (чат, пользователь) обрабатывается одновременно
+
+
+def get_update_key(update: types.Update) -> Tuple[int, int]:
+    """(чат, пользователь) - обновления с одним ключом обрабатываются по порядку, разные ключи независимы."""
+    if update.message:
+        return update.message.chat.id, update.message.from_user.id
+    if update.callback_query:
+        chat_id = update.callback_query.message.chat.id if update.callback_query.message else 0
+        return chat_id, update.callback_query.from_user.id
+    # Прочие обновления не зависят друг от друга
+    return 0, -update.update_id
+
+
+def collapse_superseded(updates: List[types.Update]) -> Dict[Tuple[int, int], List[types.Update]]:
+    """
+    Группирует обновления по чату и пользователю, сохраняя порядок.
+
+    /start сбрасывает опрос, поэтому все, что пользователь прислал в личный чат до своего последнего
+    /start, уже неактуально и отбрасывается. Сообщения того же человека в других чатах не затрагиваются.
+    """
+    grouped_updates: Dict[Tuple[int, int], List[types.Update]] = {}
+    for update in updates:
+        update_key = get_update_key(update)
+        message = update.message
+        if message and message.chat.type == "private" and message.get_command(pure=True) == "start":
+            grouped_updates[update_key] = []
+        grouped_updates.setdefault(update_key, []).append(update)
+    return grouped_updates
+
+
+async def catch_up(dp: Dispatcher) -> None:
+    """Обрабатывает обновления, накопившиеся пока бот был выключен, и подтверждает их перед обычным polling."""
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+
+    updates = []
+    offset = None
+    while True:
+        batch = await dp.bot.get_updates(offset=offset, limit=BATCH_SIZE, timeout=0)
+        if not batch:
+            break
+        updates += batch
+        offset = batch[-1].update_id + 1
+    if not updates:
+        return
+
+    grouped_updates = collapse_superseded(updates)
+    logger.info(f"Catching up {len(updates)} pending updates "
+                f"({sum(map(len, grouped_updates.values()))} after collapsing) in {len(grouped_updates)} groups")
+
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def process_group(group_updates: List[types.Update]):
+        async with semaphore:
+            # Обновления одного пользователя в одном чате обрабатываются строго по порядку
+            for update in group_updates:
+                try:
+                    await dp.process_update(update)
+                except Exception as e:
+                    logger.exception(f"Failed to process pending update {update.update_id}: {e}")
+
+    await asyncio.gather(*(process_group(group_updates) for group_updates in grouped_updates.values()))
+
+    # Подтверждаем обработанные обновления, чтобы polling начал со следующих
+    await dp.bot.get_updates(offset=offset, limit=1, timeout=0)
@@ -1,21 +1,26 @@
 import sqlite3
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List, Union, Dict, Any, Tuple, Optional
+from pathlib import Path
+from typing import List, Union, Dict, Any, Set, Tuple, Optional, Iterator, TYPE_CHECKING
 from aiogram.types import Message
 import logging
 import markups
-import io
-import pandas as pd
-from openpyxl import load_workbook
-from openpyxl.styles import Alignment, Border, Side, PatternFill
-from openpyxl.worksheet.worksheet import Worksheet
+import messages as msg
+
+if TYPE_CHECKING:
+    # Тяжелые библиотеки отчетов загружаются только при первом запросе Excel-отчета
+    import io
+    import pandas as pd
+    from openpyxl.worksheet.worksheet import Worksheet
 
 
 class Database:
     TABLE_DEFINITIONS = {
         "users": [
-            ("user_id", "TEXT PRIMARY KEY"),
-            ("source", "TEXT"),
+            ("user_id", "INTEGER PRIMARY KEY"),
+            ("source", "TEXT NOT NULL"),
+            ("external_id", "INTEGER NOT NULL"),
             ("first_name", "TEXT"),
             ("last_name", "TEXT"),
             ("username", "TEXT"),
@@ -25,6 +30,7 @@ class Database:
             ("is_active", "INTEGER DEFAULT 1"),
             ("start_message_id", "INTEGER"),
             # ("start_message_text", "TEXT")
+            ("UNIQUE", "(source, external_id)"),
         ],
         "answers": [
             ("answer_id", "INTEGER PRIMARY KEY AUTOINCREMENT"),
@@ -32,9 +38,70 @@ class Database:
             ("question_id", "INTEGER"),
             ("answer_text", "TEXT"),
             ("answer_date", "TEXT"),
+        ],
+        "broadcasts": [
+            ("job_id", "INTEGER PRIMARY KEY AUTOINCREMENT"),
+            ("message_text", "TEXT"),
+            ("status", "TEXT DEFAULT 'running'"),
+            ("status_message_id", "INTEGER"),
+            ("created_date", "TEXT"),
+            ("finished_date", "TEXT"),
+        ],
+        "broadcast_recipients": [
+            ("job_id", "INTEGER"),
+            ("user_id", "INTEGER"),
+            ("chat_id", "INTEGER"),
+            ("status", "TEXT DEFAULT 'pending'"),
+            ("PRIMARY KEY", "(job_id, user_id)"),
+        ],
+        "processed_callbacks": [
+            ("callback_key", "TEXT PRIMARY KEY"),
+            ("processed_date", "TEXT"),
+        ]
+    }
+
+    # Индексы под фильтры аудитории рассылок
+    INDEX_DEFINITIONS = {
+        "idx_users_source_active": ("users", "source, is_active, progress"),
+        "idx_users_registration_date": ("users", "registration_date"),
+        "idx_users_last_activity": ("users", "last_activity"),
+        "idx_answers_user_question": ("answers", "user_id, question_id, answer_id"),
+        "idx_broadcast_recipients_status": ("broadcast_recipients", "job_id, status, user_id"),
+        "idx_processed_callbacks_date": ("processed_callbacks", "processed_date"),
+    }
+
+    # Сводные таблицы аналитики, которые обновляются триггерами при записи (см. create_rollups)
+    ROLLUP_TABLE_DEFINITIONS = {
+        # Какие шаги прошел и на какие вопросы ответил каждый пользователь (kind: 'step' / 'question')
+        "funnel_user_steps": [
+            ("user_id", "INTEGER"),
+            ("kind", "TEXT"),
+            ("key", "INTEGER"),
+            ("PRIMARY KEY", "(user_id, kind, key)"),
+        ],
+        # Число пользователей по шагу / вопросу; kind 'current' - сколько пользователей сейчас на шаге
+        "funnel_counts": [
+            ("kind", "TEXT"),
+            ("key", "INTEGER"),
+            ("user_count", "INTEGER DEFAULT 0"),
+            ("PRIMARY KEY", "(kind, key)"),
+        ],
+        # Регистрации и ответы по часам и дням (period: 'hour' / 'day')
+        "activity_rollups": [
+            ("period", "TEXT"),
+            ("period_start", "TEXT"),
+            ("registrations", "INTEGER DEFAULT 0"),
+            ("answers", "INTEGER DEFAULT 0"),
+            ("PRIMARY KEY", "(period, period_start)"),
         ]
     }
 
+    # Длина префикса даты "%Y-%m-%d %H:%M:%S", задающая начало периода
+    ACTIVITY_PERIODS = {"hour": 13, "day": 10}
+
+    # Таблицы, которые попадают в Excel-отчет; служебные таблицы (очереди, кэши, сводки) не выгружаются
+    EXCEL_REPORT_TABLES = ["users", "answers", "broadcasts"]
+
     QUESTIONS = {
         1: "Загранпаспорт, действующий более 2х лет",
         2: "Действующая шенгенская виза",
@@ -42,19 +109,317 @@ class Database:
         4: "Страна местонахождения"
     }
 
+    STEP_NAMES = {
+        1: "Приветствие",
+        2: "Вопрос о загранпаспорте",
+        3: "Вопрос о шенгенской визе",
+        4: "Срок окончания визы",
+        5: "Страна местонахождения",
+        6: "Страна (свой вариант)",
+        0: "Опрос завершен",
+        -1: "Сразу к консультации",
+        -2: "Задал вопрос",
+    }
+
+    READ_POOL_SIZE = 2
+
     def __init__(self, db_file: str) -> None:
         self.db_file = db_file
         self.connection = sqlite3.connect(db_file)
         self.connection.row_factory = sqlite3.Row
         self.cursor = self.connection.cursor()
+        # Соединения только для чтения под отчеты, чтобы они не держали блокировки пути записи
+        self.read_pool: List[sqlite3.Connection] = []
+        if db_file != ":memory:":
+            # В режиме WAL читатели и писатель не блокируют друг друга
+            self.connection.execute("PRAGMA journal_mode=WAL")
+
+    @contextmanager
+    def read_connection(self) -> Iterator[sqlite3.Connection]:
+        """
+        Выдает соединение только для чтения из пула.
+
+        Все запросы внутри блока видят один и тот же снимок базы.
+        """
+        if self.db_file == ":memory:":
+            # Базу в памяти нельзя открыть вторым соединением
+            yield self.connection
+            return
+
+        if self.read_pool:
+            connection = self.read_pool.pop()
+        else:
+            connection = sqlite3.connect(f"file:{self.db_file}?mode=ro", uri=True)
+            connection.row_factory = sqlite3.Row
+
+        connection.execute("BEGIN")
+        try:
+            yield connection
+        finally:
+            connection.rollback()
+            if len(self.read_pool) < self.READ_POOL_SIZE:
+                self.read_pool.append(connection)
+            else:
+                connection.close()
+
+    def create_snapshot(self, table_names: List[str]) -> sqlite3.Connection:
+        """
+        Копирует указанные таблицы в память - выгрузки работают с копией, а не с рабочей базой.
+
+        Снимок открывает собственное соединение, поэтому его можно делать вне потока event loop.
+        """
+        snapshot = sqlite3.connect(":memory:", uri=True, isolation_level=None)
+        snapshot.row_factory = sqlite3.Row
+        if self.db_file == ":memory:":
+            # Базу в памяти нельзя подключить к другому соединению - копируем ее целиком
+            with self.read_connection() as connection:
+                connection.backup(snapshot)
+            return snapshot
+
+        snapshot.execute("ATTACH DATABASE ? AS live", (Path(self.db_file).resolve().as_uri() + "?mode=ro",))
+        # Все таблицы копируются в одной транзакции и согласованы между собой
+        snapshot.execute("BEGIN")
+        for table_name in table_names:
+            snapshot.execute(f"CREATE TABLE main.{table_name} AS SELECT * FROM live.{table_name}")
+        snapshot.execute("COMMIT")
+        snapshot.execute("DETACH DATABASE live")
+        return snapshot
 
     def initialize_database(self):
+        self.migrate_text_user_ids()
         with self.connection:
             for table_name, table_columns in self.TABLE_DEFINITIONS.items():
                 if table_name != "questions":
                     self.create_table(table_name, table_columns)
+            for index_name, (table_name, columns) in self.INDEX_DEFINITIONS.items():
+                self.cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({columns})")
+            self.create_answers_search_index()
+            self.create_rollups()
         logging.info("Database initialized successfully.")
 
+    def migrate_text_user_ids(self) -> None:
+        """
+        Переводит базу со старых ключей пользователей вида "telegram_123456" на (source, external_id)
+        с целочисленным user_id, на который ссылаются answers и broadcast_recipients.
+        """
+        user_columns = [row['name'] for row in self.cursor.execute("PRAGMA table_info(users)").fetchall()]
+        if not user_columns or "external_id" in user_columns:
+            return
+
+        old_tables = [row['name'] for row in self.cursor.execute(
+            "SELECT name FROM sqlite_master "
+            "WHERE type = 'table' AND name IN ('users', 'answers', 'broadcast_recipients')"
+        ).fetchall()]
+
+        self.cursor.execute("BEGIN")
+        with self.connection:
+            for table_name in old_tables:
+                self.cursor.execute(f"ALTER TABLE {table_name} RENAME TO {table_name}_old")
+                self.create_table(table_name, self.TABLE_DEFINITIONS[table_name])
+
+            self.cursor.execute("""
+                INSERT INTO users (source, external_id, first_name, last_name, username, registration_date,
+                                   progress, last_activity, is_active, start_message_id)
+                SELECT source, CAST(substr(user_id, length(source) + 2) AS INTEGER), first_name, last_name,
+                       username, registration_date, progress, last_activity, is_active, start_message_id
+                FROM users_old
+                ORDER BY registration_date
+            """)
+            # Старые ответы и получатели рассылок хранили текстовый ключ - сопоставляем его с новым user_id
+            old_key_join = "JOIN users ON users.source || '_' || users.external_id = old.user_id"
+            if "answers" in old_tables:
+                self.cursor.execute(f"""
+                    INSERT INTO answers (answer_id, user_id, question_id, answer_text, answer_date)
+                    SELECT old.answer_id, users.user_id, old.question_id, old.answer_text, old.answer_date
+                    FROM answers_old AS old {old_key_join}
+                """)
+            if "broadcast_recipients" in old_tables:
+                self.cursor.execute(f"""
+                    INSERT INTO broadcast_recipients (job_id, user_id, chat_id, status)
+                    SELECT old.job_id, users.user_id, users.external_id, old.status
+                    FROM broadcast_recipients_old AS old {old_key_join}
+                """)
+
+            for table_name in old_tables:
+                self.cursor.execute(f"DROP TABLE {table_name}_old")
+        logging.info("User keys migrated to (source, external_id).")
+
+    def create_answers_search_index(self) -> None:
+        """Полнотекстовый индекс FTS5 по answers.answer_text, синхронизируемый триггерами."""
+        is_index_exists = self.cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'answers_fts'"
+        ).fetchone()
+
+        self.cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS answers_fts USING fts5(
+                answer_text, content='answers', content_rowid='answer_id', tokenize='unicode61 remove_diacritics 2'
+            )
+        """)
+        self.cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS answers_fts_insert AFTER INSERT ON answers BEGIN
+                INSERT INTO answers_fts (rowid, answer_text) VALUES (new.answer_id, new.answer_text);
+            END
+        """)
+        self.cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS answers_fts_delete AFTER DELETE ON answers BEGIN
+                INSERT INTO answers_fts (answers_fts, rowid, answer_text)
+                VALUES ('delete', old.answer_id, old.answer_text);
+            END
+        """)
+        self.cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS answers_fts_update AFTER UPDATE OF answer_text ON answers BEGIN
+                INSERT INTO answers_fts (answers_fts, rowid, answer_text)
+                VALUES ('delete', old.answer_id, old.answer_text);
+                INSERT INTO answers_fts (rowid, answer_text) VALUES (new.answer_id, new.answer_text);
+            END
+        """)
+
+        if not is_index_exists:
+            # Индексируем ответы, записанные до появления индекса
+            self.cursor.execute("INSERT INTO answers_fts (answers_fts) VALUES ('rebuild')")
+
+    def create_rollups(self) -> None:
+        """
+        Создает сводные таблицы воронки и активности и триггеры, которые обновляют их
+        при каждой записи пользователя, прогресса и ответа - отчеты не сканируют answers.
+        """
+        is_rollups_exists = self.cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'funnel_counts'"
+        ).fetchone()
+        for table_name, table_columns in self.ROLLUP_TABLE_DEFINITIONS.items():
+            self.create_table(table_name, table_columns)
+
+        def reach(kind: str, key: str) -> str:
+            # Счетчик растет только при первом достижении шага / вопросе пользователем
+            return f"""
+                INSERT INTO funnel_counts (kind, key, user_count)
+                SELECT '{kind}', {key}, 1
+                WHERE NOT EXISTS (SELECT 1 FROM funnel_user_steps
+                                  WHERE user_id = new.user_id AND kind = '{kind}' AND key = {key})
+                ON CONFLICT (kind, key) DO UPDATE SET user_count = user_count + 1;
+                INSERT OR IGNORE INTO funnel_user_steps (user_id, kind, key) VALUES (new.user_id, '{kind}', {key});
+            """
+
+        def move_current(key: str, delta: int) -> str:
+            return f"""
+                INSERT INTO funnel_counts (kind, key, user_count) VALUES ('current', {key}, {delta})
+                ON CONFLICT (kind, key) DO UPDATE SET user_count = user_count + {delta};
+            """
+
+        def count_activity(column: str, date: str) -> str:
+            return "".join(f"""
+                INSERT INTO activity_rollups (period, period_start, {column})
+                SELECT '{period}', substr({date}, 1, {length}), 1 WHERE {date} IS NOT NULL
+                ON CONFLICT (period, period_start) DO UPDATE SET {column} = {column} + 1;
+            """ for period, length in self.ACTIVITY_PERIODS.items())
+
+        self.cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS users_rollup_insert AFTER INSERT ON users BEGIN
+                {reach('step', 'new.progress')}
+                {move_current('new.progress', 1)}
+                {count_activity('registrations', 'new.registration_date')}
+            END
+        """)
+        self.cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS users_rollup_progress AFTER UPDATE OF progress ON users
+            WHEN new.progress IS NOT old.progress BEGIN
+                {move_current('old.progress', -1)}
+                {move_current('new.progress', 1)}
+                {reach('step', 'new.progress')}
+            END
+        """)
+        self.cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS answers_rollup_insert AFTER INSERT ON answers BEGIN
+                {reach('question', 'new.question_id')}
+                {count_activity('answers', 'new.answer_date')}
+            END
+        """)
+
+        if not is_rollups_exists:
+            # Заполняем сводные таблицы по данным, записанным до их появления. Пройденные шаги
+            # восстанавливаются приблизительно: текущий шаг, шаги, на вопросы которых есть ответ, и все
+            # шаги, мимо которых к ним не пройти. Шаг 6 (страна своим вариантом) по истории не отличить от шага 5.
+            self.cursor.execute("INSERT OR IGNORE INTO funnel_user_steps SELECT user_id, 'step', progress FROM users")
+            self.cursor.executemany(
+                "INSERT OR IGNORE INTO funnel_user_steps SELECT DISTINCT user_id, 'step', ? FROM answers "
+                "WHERE question_id = ?",
+                [(step, question_id) for question_id, step in self.get_question_steps().items()]
+            )
+            self.cursor.executemany(
+                "INSERT OR IGNORE INTO funnel_user_steps SELECT user_id, 'step', ? FROM funnel_user_steps "
+                "WHERE kind = 'step' AND key = ?",
+                [(required_step, step) for step, required_steps in self.get_required_steps().items()
+                 for required_step in required_steps]
+            )
+            self.cursor.execute(
+                "INSERT OR IGNORE INTO funnel_user_steps SELECT DISTINCT user_id, 'question', question_id FROM answers"
+            )
+            self.cursor.execute("""
+                INSERT INTO funnel_counts (kind, key, user_count)
+                SELECT kind, key, COUNT(*) FROM funnel_user_steps GROUP BY kind, key
+            """)
+            self.cursor.execute("""
+                INSERT INTO funnel_counts (kind, key, user_count)
+                SELECT 'current', progress, COUNT(*) FROM users GROUP BY progress
+            """)
+            # Отметка о том, сколько пользователей восстановлено по истории - отчет предупреждает о приближении
+            self.cursor.execute("""
+                INSERT INTO funnel_counts (kind, key, user_count)
+                SELECT 'backfill', 0, COUNT(*) FROM users HAVING COUNT(*) > 0
+            """)
+            for period, length in self.ACTIVITY_PERIODS.items():
+                self.cursor.execute(f"""
+                    INSERT INTO activity_rollups (period, period_start, registrations)
+                    SELECT '{period}', substr(registration_date, 1, {length}), COUNT(*) FROM users
+                    WHERE registration_date IS NOT NULL GROUP BY 2
+                """)
+                self.cursor.execute(f"""
+                    INSERT INTO activity_rollups (period, period_start, answers)
+                    SELECT '{period}', substr(answer_date, 1, {length}), COUNT(*) FROM answers
+                    WHERE answer_date IS NOT NULL GROUP BY 2
+                    ON CONFLICT (period, period_start) DO UPDATE SET answers = excluded.answers
+                """)
+
+    @staticmethod
+    def get_question_steps() -> Dict[int, int]:
+        """Первый шаг сценария, на котором задается каждый вопрос (без дополнительных вопросов 0)."""
+        question_steps = {}
+        for step in sorted(step for step in msg.script_data if step > 0):
+            question_id = msg.script_data[step].get("question_id")
+            if question_id:
+                question_steps.setdefault(question_id, step)
+        return question_steps
+
+    @staticmethod
+    def get_required_steps() -> Dict[int, Set[int]]:
+        """
+        Шаги сценария, через которые проходит любой путь от приветствия до данного шага
+        (переходы "назад" не учитываются).
+        """
+        next_steps = {}
+        for step, script_item in msg.script_data.items():
+            actions = script_item.get("actions", {})
+            next_steps[step] = {next_step for action, next_step in actions.items() if action != "go_back"}
+            if "listen" in script_item:
+                next_steps[step].add(script_item["listen"])
+        previous_steps = {step: {prev_step for prev_step, steps in next_steps.items() if step in steps}
+                          for step in msg.script_data}
+
+        first_step = min(step for step in msg.script_data if step > 0)
+        required_steps = {step: set(msg.script_data) for step in msg.script_data}
+        required_steps[first_step] = {first_step}
+        is_changed = True
+        while is_changed:
+            is_changed = False
+            for step in msg.script_data:
+                if step == first_step or not previous_steps[step]:
+                    continue
+                steps = set.intersection(*(required_steps[prev_step] for prev_step in previous_steps[step])) | {step}
+                if steps != required_steps[step]:
+                    required_steps[step] = steps
+                    is_changed = True
+        return {step: steps - {step} for step, steps in required_steps.items() if step != first_step}
+
     def create_table(self, table_name: str, columns: list):
         columns_with_types = ", ".join([" ".join(column) for column in columns])
         self.cursor.execute(f"CREATE TABLE IF NOT EXISTS {table_name} ({columns_with_types})")
@@ -87,7 +452,7 @@ class Database:
 
         return data if data else None
 
-    def insert_into_table(self, table_name: str, values: Dict[str, Any]) -> None:
+    def insert_into_table(self, table_name: str, values: Dict[str, Any]) -> int:
         with self.connection:
             cursor = self.connection.cursor()
 
@@ -100,6 +465,7 @@ class Database:
 
             # Выполняем запрос
             cursor.execute(sql, list(values.values()))
+        return cursor.lastrowid
 
     def update_table(self, table_name: str, values: Dict[str, Any],
                      conditions: Dict[str, Any]) -> Union[Dict[str, Any], None]:
@@ -128,20 +494,21 @@ class Database:
         return self.get_row_as_dict(conditions, table_name)
 
     def create_and_update_user(self, message: Message, source: str) -> Dict[str, Any]:
-        user_id = self.generate_unique_user_id(source, message.from_user.id)
-        user_data = self.get_row_as_dict({'user_id': user_id}, ['users'])
+        user_data = self.get_user(source, message.from_user.id)
 
         if user_data:
             updated_data = {
                 'last_name': user_data['last_name'] or message.from_user.last_name or "Not specified",
                 'progress': 1,
-                'last_activity': self.get_current_time_formatted()}
-            user_data = self.update_table("users", updated_data, {"user_id": user_id})
+                'last_activity': self.get_current_time_formatted(),
+                # Пользователь снова пишет боту - значит, он его разблокировал
+                'is_active': 1}
+            user_data = self.update_table("users", updated_data, {"user_id": user_data["user_id"]})
             return user_data
         else:
             user_data = {
-                "user_id": user_id,
                 "source": source,
+                "external_id": message.from_user.id,
                 "first_name": message.from_user.first_name,
                 "last_name": message.from_user.last_name or "Not specified",
                 "username": message.from_user.username,
@@ -152,10 +519,10 @@ class Database:
                 "start_message_id": None
             }
 
-            self.insert_into_table("users", user_data)
+            user_data["user_id"] = self.insert_into_table("users", user_data)
         return user_data
 
-    def move_user(self, user_id: str, forward=True) -> Dict[str, Any]:
+    def move_user(self, user_id: int, forward=True) -> Dict[str, Any]:
         user_data = self.get_row_as_dict({'user_id': user_id}, 'users')
         if user_data:
             step = 1 if forward else -1
@@ -163,10 +530,10 @@ class Database:
             self.update_user_progress(user_id, user_data['progress'])
         return user_data
 
-    def update_user_progress(self, user_id: str, new_progress: int) -> Dict:
+    def update_user_progress(self, user_id: int, new_progress: int) -> Dict:
         return self.update_table("users", {"progress": new_progress}, {"user_id": user_id})
 
-    def update_user_status(self, user_id: str, new_status: str):
+    def update_user_status(self, user_id: int, new_status: str):
         self.update_table("users", {"status": new_status}, {"user_id": user_id})
 
     def record_answer(self, user_data, answer, question_id):
@@ -201,7 +568,7 @@ class Database:
 
         return None
 
-    def get_last_answer(self, user_id: str):
+    def get_last_answer(self, user_id: int):
         query = """
             SELECT * FROM answers 
             WHERE user_id = ? 
@@ -215,18 +582,20 @@ class Database:
     def get_current_time_formatted():
         return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    @staticmethod
-    def generate_unique_user_id(source: str, user_id: int) -> str:
-        return f"{source}_{user_id}"
+    def get_user(self, source: str, external_id: int) -> Union[Dict[str, Any], None]:
+        return self.get_row_as_dict({'source': source, 'external_id': external_id}, 'users')
 
     def get_user_by_username(self, username: str):
         query = "SELECT * FROM users WHERE username = ?"
         row = self.cursor.execute(query, (username,)).fetchone()
         return dict(row) if row else None
 
-    def get_user_info_for_group_chat(self, user_id: str):
-        # Получение информации о пользователе
-        user_data = self.get_row_as_dict({'user_id': user_id}, ['users'])
+    def get_user_info_for_group_chat(self, user_id: int):
+        # Получение информации о пользователе и его ответов из одного снимка базы
+        with self.read_connection() as connection:
+            user_row = connection.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            answers = connection.execute("SELECT * FROM answers WHERE user_id = ?", (user_id,)).fetchall()
+        user_data = dict(user_row) if user_row else None
 
         if user_data:
             # Формирование сообщения с информацией о пользователе
@@ -238,7 +607,6 @@ class Database:
                             f"Дата регистрации: {user_data['registration_date']}\n" \
                             f"Дата последней активности: {user_data['last_activity']}\n\n"
 
-            answers = self.get_answers_by_user_id(user_id)
             additional_questions = []
             last_answers = {}
 
@@ -262,32 +630,60 @@ class Database:
 
             return user_info_msg
 
-    def get_answers_by_user_id(self, user_id: str):
+    def get_answers_by_user_id(self, user_id: int):
         return self.cursor.execute(
             "SELECT * FROM answers WHERE user_id = ?", (user_id,)
         ).fetchall()
 
+    def search_answers(self, terms: str, limit: int = 20) -> List[Dict[str, Any]]:
+        """
+        Ищет ответы по словам через FTS5, лучшие совпадения первыми.
+
+        Каждое слово ищется как префикс, поэтому "испан" найдет "Испания".
+        """
+        words = terms.replace('"', ' ').split()
+        if not words:
+            return []
+        match_query = " ".join(f'"{word}"*' for word in words)
+
+        with self.read_connection() as connection:
+            rows = connection.execute(
+                """
+                SELECT users.username, users.first_name, answers.question_id, answers.answer_text, answers.answer_date
+                FROM answers_fts
+                JOIN answers ON answers.answer_id = answers_fts.rowid
+                JOIN users ON users.user_id = answers.user_id
+                WHERE answers_fts MATCH ?
+                ORDER BY bm25(answers_fts)
+                LIMIT ?
+                """,
+                (match_query, limit)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
     def get_question_text(self, question_id: int):
         question = self.get_row_as_dict({'question_id': question_id}, 'questions')
         return question['question_text'] if question else "Неизвестный вопрос"
 
     def get_report(self) -> str:
-        # Получить общее количество пользователей
-        total_users = self.cursor.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        with self.read_connection() as connection:
+            # Получить общее количество пользователей
+            total_users = connection.execute("SELECT COUNT(*) FROM users").fetchone()[0]
 
-        # Получить количество пользователей по источнику
-        user_sources = self.cursor.execute(
-            "SELECT source, COUNT(*) FROM users GROUP BY source"
-        ).fetchall()
-        sources_text = "\n".join([f"{source}: {count}" for source, count in user_sources])
+            # Получить количество пользователей по источнику
+            user_sources = connection.execute(
+                "SELECT source, COUNT(*) FROM users GROUP BY source"
+            ).fetchall()
 
-        # Получить количество пользователей, которые не закончили опрос
-        users_incomplete = self.cursor.execute(
-            "SELECT COUNT(*) FROM users WHERE progress > 0"
-        ).fetchone()[0]
+            # Получить количество пользователей, которые не закончили опрос
+            users_incomplete = connection.execute(
+                "SELECT COUNT(*) FROM users WHERE progress > 0"
+            ).fetchone()[0]
 
-        # Получить количество активных и заблокированных пользователей
-        active_users = self.cursor.execute("SELECT COUNT(*) FROM users WHERE is_active = 1").fetchone()[0]
+            # Получить количество активных и заблокированных пользователей
+            active_users = connection.execute("SELECT COUNT(*) FROM users WHERE is_active = 1").fetchone()[0]
+
+        sources_text = "\n".join([f"{source}: {count}" for source, count in user_sources])
         blocked_users = total_users - active_users
 
         report = f"📊 Отчет\n\n"
@@ -299,19 +695,65 @@ class Database:
 
         return report
 
-    def create_excel_report(self) -> Tuple[io.BytesIO, str]:
-        table_names = [row[0] for row in
-                       self.cursor.execute("SELECT name FROM sqlite_master WHERE type='table';").fetchall()
-                       if row[0] != 'sqlite_sequence']
+    def get_funnel_report(self) -> str:
+        with self.read_connection() as connection:
+            rows = connection.execute("SELECT kind, key, user_count FROM funnel_counts").fetchall()
+        counts = {(kind, key): user_count for kind, key, user_count in rows}
+
+        report = "📉 Воронка опроса\n\nДошли до шага:\n"
+        for step, step_name in self.STEP_NAMES.items():
+            report += f"{step_name}: {counts.get(('step', step), 0)}\n"
+
+        report += "\nОтветили на вопрос:\n"
+        for question_id, question_text in self.QUESTIONS.items():
+            report += f"{question_id}. {question_text}: {counts.get(('question', question_id), 0)}\n"
+
+        # Пользователи, которые сейчас стоят на незавершенном шаге, на нем и остановились
+        report += "\nОстановились на шаге:\n"
+        for step, step_name in self.STEP_NAMES.items():
+            if step > 0:
+                report += f"{step_name}: {counts.get(('current', step), 0)}\n"
+
+        if ('backfill', 0) in counts:
+            report += "\nℹ️ Пройденные шаги за период до запуска воронки восстановлены по ответам и приблизительны."
+        return report
+
+    def get_activity_report(self, hours: int = 24, days: int = 14) -> str:
+        with self.read_connection() as connection:
+            hourly = connection.execute(
+                "SELECT * FROM activity_rollups WHERE period = 'hour' ORDER BY period_start DESC LIMIT ?", (hours,)
+            ).fetchall()
+            daily = connection.execute(
+                "SELECT * FROM activity_rollups WHERE period = 'day' ORDER BY period_start DESC LIMIT ?", (days,)
+            ).fetchall()
+
+        report = "📈 Активность (регистрации / ответы)\n\nПо часам:\n"
+        report += "\n".join(f"{row['period_start']}:00 - {row['registrations']} / {row['answers']}"
+                             for row in reversed(hourly))
+        report += "\n\nПо дням:\n"
+        report += "\n".join(f"{row['period_start']} - {row['registrations']} / {row['answers']}"
+                             for row in reversed(daily))
+
+        return report
+
+    def create_excel_report(self) -> Tuple["io.BytesIO", str]:
+        import io
+        import pandas as pd
+        from openpyxl import load_workbook
+
+        # Выгрузка читает снимок базы, поэтому не задерживает запись ответов пользователей
+        table_names = self.EXCEL_REPORT_TABLES
+        snapshot = self.create_snapshot(table_names)
 
         output = io.BytesIO()
         dfs = {}
         with pd.ExcelWriter(output, engine='openpyxl') as writer:
             for table_name in table_names:
                 query = f"SELECT * FROM {table_name}"
-                df = pd.read_sql(query, self.connection)
+                df = pd.read_sql(query, snapshot)
                 df.to_excel(writer, sheet_name=table_name, index=False)
                 dfs[table_name] = df
+        snapshot.close()
 
         output.seek(0)
         wb = load_workbook(output)
@@ -327,15 +769,147 @@ class Database:
 
         return output, file_name
 
-    def get_all_users_id(self, messenger: str) -> List[str]:
-        """Возвращает список ID пользователей для заданного мессенджера."""
-        query = "SELECT user_id FROM users WHERE source = ?"
-        result = self.cursor.execute(query, (messenger,)).fetchall()
-        return [row['user_id'] for row in result]
+    def build_audience_query(self, filters: Dict[str, Any]) -> Tuple[str, List[Any]]:
+        """
+        Собирает один SQL-запрос, выбирающий (user_id, chat_id) пользователей под фильтры рассылки.
+
+        :param filters: Словарь фильтров:
+            source - мессенджер (по умолчанию 'telegram');
+            is_active - 1 / 0;
+            completed - True (опрос закончен) / False (не закончен);
+            answers - {question_id: answer}, последний ответ пользователя на вопрос;
+            registration_date, last_activity - кортеж (с, по), любая граница может быть None.
+        :return: SQL-запрос и список параметров.
+        """
+        conditions = ["source = ?"]
+        params = [filters.get("source", "telegram")]
+
+        if filters.get("is_active") is not None:
+            conditions.append("is_active = ?")
+            params.append(int(filters["is_active"]))
+
+        if filters.get("completed") is not None:
+            conditions.append("progress <= 0" if filters["completed"] else "progress > 0")
+
+        for question_id, answer in filters.get("answers", {}).items():
+            conditions.append("""
+                (SELECT answer_text FROM answers
+                 WHERE answers.user_id = users.user_id AND answers.question_id = ?
+                 ORDER BY answer_id DESC LIMIT 1) = ?""")
+            params += [question_id, markups.inline_button_texts.get(answer, answer)]
+
+        for column in ("registration_date", "last_activity"):
+            date_from, date_to = filters.get(column, (None, None))
+            if date_from:
+                conditions.append(f"{column} >= ?")
+                params.append(date_from)
+            if date_to:
+                conditions.append(f"{column} <= ?")
+                params.append(date_to)
+
+        query = f"""
+            SELECT user_id, external_id AS chat_id
+            FROM users
+            WHERE {" AND ".join(conditions)}
+        """
+        return query, params
+
+    def create_broadcast_job(self, message_text: str, audience_filters: Dict[str, Any],
+                             status_message_id: int) -> int:
+        """Сохраняет рассылку и список получателей, чтобы ее можно было продолжить после перезапуска."""
+        audience_query, audience_params = self.build_audience_query(audience_filters)
+        with self.connection:
+            cursor = self.connection.cursor()
+            cursor.execute(
+                "INSERT INTO broadcasts (message_text, status, status_message_id, created_date) VALUES (?, ?, ?, ?)",
+                (message_text, "running", status_message_id, self.get_current_time_formatted())
+            )
+            job_id = cursor.lastrowid
+            # Получатели переносятся одним INSERT ... SELECT, без промежуточного списка в Python
+            cursor.execute(
+                f"""
+                INSERT OR IGNORE INTO broadcast_recipients (job_id, user_id, chat_id, status)
+                SELECT ?, audience.user_id, audience.chat_id, 'pending' FROM ({audience_query}) AS audience
+                """,
+                [job_id] + audience_params
+            )
+        return job_id
+
+    def get_unfinished_broadcast_jobs(self) -> List[Dict[str, Any]]:
+        rows = self.cursor.execute("SELECT * FROM broadcasts WHERE status = 'running'").fetchall()
+        return [dict(row) for row in rows]
+
+    def iter_pending_recipients(self, job_id: int, batch_size: int = 500) -> Iterator[Tuple[int, int]]:
+        """Отдает (user_id, chat_id) неотправленных получателей порциями по batch_size."""
+        last_user_id = 0
+        while True:
+            rows = self.connection.execute(
+                """
+                SELECT user_id, chat_id FROM broadcast_recipients
+                WHERE job_id = ? AND status = 'pending' AND user_id > ?
+                ORDER BY user_id
+                LIMIT ?
+                """,
+                (job_id, last_user_id, batch_size)
+            ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row['user_id'], row['chat_id']
+            last_user_id = rows[-1]['user_id']
+
+    def mark_broadcast_recipient(self, job_id: int, user_id: int, status: str) -> None:
+        """Фиксирует результат отправки одному получателю (sent / blocked / failed)."""
+        with self.connection:
+            self.cursor.execute(
+                "UPDATE broadcast_recipients SET status = ? WHERE job_id = ? AND user_id = ?",
+                (status, job_id, user_id)
+            )
+            if status in ("sent", "blocked"):
+                self.cursor.execute("UPDATE users SET is_active = ? WHERE user_id = ?",
+                                    (int(status == "sent"), user_id))
+
+    def get_broadcast_progress(self, job_id: int) -> Dict[str, int]:
+        rows = self.cursor.execute(
+            "SELECT status, COUNT(*) FROM broadcast_recipients WHERE job_id = ? GROUP BY status", (job_id,)
+        ).fetchall()
+        progress = {"pending": 0, "sent": 0, "blocked": 0, "failed": 0}
+        progress.update({status: count for status, count in rows})
+        progress["total"] = sum(progress.values())
+        return progress
+
+    def retry_failed_broadcast_recipients(self, job_id: int) -> int:
+        """Возвращает получателей с неудачной отправкой в очередь задания. Возвращает их количество."""
+        with self.connection:
+            cursor = self.connection.execute(
+                "UPDATE broadcast_recipients SET status = 'pending' WHERE job_id = ? AND status = 'failed'", (job_id,)
+            )
+            return cursor.rowcount
+
+    def finish_broadcast_job(self, job_id: int) -> None:
+        self.update_table("broadcasts", {"status": "finished", "finished_date": self.get_current_time_formatted()},
+                          {"job_id": job_id})
+
+    def claim_callback_keys(self, callback_keys: List[str]) -> bool:
+        """
+        Отмечает callback как обработанный.
+
+        :return: False, если хотя бы один из ключей уже был обработан (в том числе другим процессом).
+        """
+        current_time = self.get_current_time_formatted()
+        with self.connection:
+            cursor = self.connection.cursor()
+            cursor.executemany("INSERT OR IGNORE INTO processed_callbacks (callback_key, processed_date) VALUES (?, ?)",
+                               [(key, current_time) for key in callback_keys])
+            return cursor.rowcount == len(callback_keys)
+
+    def delete_processed_callbacks(self, older_than: str) -> None:
+        with self.connection:
+            self.cursor.execute("DELETE FROM processed_callbacks WHERE processed_date < ?", (older_than,))
 
     @staticmethod
-    def apply_table_styles(sheet: Worksheet,
-                           dataframe: pd.DataFrame,
+    def apply_table_styles(sheet: "Worksheet",
+                           dataframe: "pd.DataFrame",
                            start_row: int,
                            list_with_widths: Optional[List[int]] = None,
                            table_border: str = 'thin',
@@ -347,6 +921,8 @@ class Database:
                            cell_colors: Optional[Dict[str, List[str]]] = None,
                            range_colors: Optional[Dict[str, List[str]]] = None,
                            condition: Optional[callable] = None) -> None:
+        from openpyxl.styles import Alignment, Border, Side, PatternFill
+
         # Set column widths
         if list_with_widths:
             for i, width in enumerate(list_with_widths, start=1):
@@ -420,6 +996,9 @@ class Database:
                         cell.fill = PatternFill(start_color=colors[0], end_color=colors[0], fill_type="solid")
 
     def close(self):
+        for connection in self.read_pool:
+            connection.close()
+        self.read_pool.clear()
         if self.connection:
             self.connection.close()
             print("Database connection closed.")
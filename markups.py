@@ -4,7 +4,13 @@ import messages as msg
 # Text
 inline_button_texts = {
     "get_excel_report": "📊 Отчет Excel",
+    "get_funnel_report": "📉 Воронка",
+    "get_activity_report": "📈 Активность",
     "send_to_all": "📨 Отправить всем",
+    "send_to_incomplete": "⏳ Не закончившим опрос",
+    "send_to_completed": "🟢 Закончившим опрос",
+    "send_to_schengen": "🛂 С шенгенской визой",
+    "send_to_recent": "🕒 Активным за 30 дней",
     "do_not_send_to_all": "🔴 Отмена",
     "yes": "✅ Да",
     "no": "❌ Нет",
@@ -34,7 +40,11 @@ def generate_keyboard(msg_number):
 consultation_keyboard = InlineKeyboardMarkup().row(inline_btns["go_to_manager"]).row(inline_btns["back_to_survey"])
 
 # Клавиатура отчета в групповом чате
-report_keyboard = InlineKeyboardMarkup().add(inline_btns["get_excel_report"])
+report_keyboard = InlineKeyboardMarkup().add(inline_btns["get_excel_report"]) \
+    .row(inline_btns["get_funnel_report"], inline_btns["get_activity_report"])
 
 # Клавиатура групповой отправки
-send_to_all_keyboard = InlineKeyboardMarkup().add(inline_btns["send_to_all"]).add(inline_btns["do_not_send_to_all"])
+send_to_all_keyboard = InlineKeyboardMarkup().add(inline_btns["send_to_all"]) \
+    .row(inline_btns["send_to_incomplete"], inline_btns["send_to_completed"]) \
+    .row(inline_btns["send_to_schengen"], inline_btns["send_to_recent"]) \
+    .add(inline_btns["do_not_send_to_all"])
@@ -132,12 +132,40 @@ def generate_message_text(script_item, user_data=None):
 
 # ======================GROUP CHAT MESSAGES=================================
 
-send_to_all_question = "Вы хотите отправить это сообщение всем пользователям?"
+send_to_all_question = "Кому отправить это сообщение?"
 
 
-def bulk_send_report_msg(all_users=None, successful_sends=0, blocked_users=0, success=False):
+search_usage_msg = "🔎 Укажите, что искать в ответах, например: поиск Германия"
+
+
+def search_results_msg(terms, results):
+    if not results:
+        return f"🔎 По запросу «{terms}» ничего не найдено."
+    msg = f"🔎 Результаты поиска «{terms}»:\n\n"
+    for result in results:
+        author = f"@{result['username']} ({result['first_name']})" if result['username'] else result['first_name']
+        msg += f"{author}, {result['answer_date']}:\n" \
+               f"{result['answer_text']}\n\n"
+    return msg
+
+
+def anti_flood_report_msg(counters):
+    return f"\n\nАнтифлуд:\n" \
+           f"Обработано сразу: {counters['passed']}\n" \
+           f"Отложено: {counters['throttled']}\n" \
+           f"Объединено серий: {counters['coalesced']}"
+
+
+def bulk_send_progress_msg(progress):
+    return f"⏳ Идет рассылка...\n\nВсего пользователей: {progress['total']}\n" \
+           f"Обработано: {progress['total'] - progress['pending']}\n" \
+           f"Успешно доставлено: {progress['sent']}\nЗаблокированные: {progress['blocked']}\n" \
+           f"Ошибки: {progress['failed']}"
+
+
+def bulk_send_report_msg(all_users=None, successful_sends=0, blocked_users=0, failed_sends=0, success=False):
     if success:
         return f"📬 Рассылка завершена!\n\nВсего пользователей: {all_users}\n" \
-               f"Успешно доставлено: {successful_sends}\nЗаблокированные: {blocked_users}"
+               f"Успешно доставлено: {successful_sends}\nЗаблокированные: {blocked_users}\nОшибки: {failed_sends}"
     else:
         return "❌ Рассылка отменена."
@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from db import Database
+from outbound import OutboundScheduler, Priority, TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class AntiFloodMiddleware(BaseMiddleware):
+    """
+    Ограничивает частоту свободного ввода в личных чатах.
+
+    Пока у пользователя есть токены, сообщения обрабатываются как обычно. Сверх лимита сообщения
+    копятся, и после паузы COALESCE_DELAY секунд вся серия обрабатывается один раз - одним ответом
+    и одной записью в answers с объединенным текстом. Непрерывная серия принудительно обрабатывается,
+    когда в ней набирается MAX_BURST_MESSAGES сообщений или она длится дольше MAX_BURST_WINDOW секунд.
+    """
+
+    RATE = 0.5  # сообщений в секунду на пользователя
+    BURST = 5
+    COALESCE_DELAY = 2  # секунд тишины, после которых серия обрабатывается
+    MAX_BURST_MESSAGES = 20
+    MAX_BURST_WINDOW = 10  # секунд
+    MAX_BUCKETS = 10000
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.buckets: Dict[int, TokenBucket] = {}
+        self.pending: Dict[int, List[types.Message]] = {}
+        self.flush_tasks: Dict[int, asyncio.Task] = {}
+        self.burst_started: Dict[int, float] = {}
+        self.coalesced_messages = set()
+        self.counters = {"passed": 0, "throttled": 0, "coalesced": 0}
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        if message.chat.type != "private" or message.is_command():
+            return
+        if id(message) in self.coalesced_messages:
+            self.coalesced_messages.discard(id(message))
+            return
+
+        user_id = message.from_user.id
+        if user_id not in self.pending:
+            bucket = self.get_bucket(user_id)
+            if bucket.wait_time() == 0:
+                bucket.consume()
+                self.counters["passed"] += 1
+                return
+
+        # Лимит исчерпан или серия уже копится - откладываем сообщение до конца серии
+        self.pending.setdefault(user_id, []).append(message)
+        self.burst_started.setdefault(user_id, time.monotonic())
+        self.counters["throttled"] += 1
+        if user_id in self.flush_tasks:
+            self.flush_tasks[user_id].cancel()
+        # Без ограничения серия непрерывно пишущего пользователя никогда бы не обработалась
+        burst_exceeded = (len(self.pending[user_id]) >= self.MAX_BURST_MESSAGES
+                          or time.monotonic() - self.burst_started[user_id] >= self.MAX_BURST_WINDOW)
+        delay = 0 if burst_exceeded else self.COALESCE_DELAY
+        self.flush_tasks[user_id] = asyncio.create_task(self.flush(user_id, delay))
+        raise CancelHandler()
+
+    def get_bucket(self, user_id: int) -> TokenBucket:
+        if user_id not in self.buckets:
+            if len(self.buckets) >= self.MAX_BUCKETS:
+                # Полные корзины ничего не ограничивают - их можно забыть
+                for idle_user_id in [key for key, bucket in self.buckets.items() if bucket.wait_time() == 0]:
+                    del self.buckets[idle_user_id]
+            self.buckets[user_id] = TokenBucket(self.RATE, self.BURST)
+        return self.buckets[user_id]
+
+    async def flush(self, user_id: int, delay: float) -> None:
+        await asyncio.sleep(delay)
+        self.flush_tasks.pop(user_id, None)
+        self.burst_started.pop(user_id, None)
+        messages = self.pending.pop(user_id, [])
+        if not messages:
+            return
+
+        # Серия передается обработчикам как одно сообщение с объединенным текстом
+        coalesced = types.Message.to_object(messages[-1].to_python())
+        coalesced.text = "\n".join(message.text for message in messages if message.text) or None
+        self.coalesced_messages.add(id(coalesced))
+        self.counters["coalesced"] += 1
+        try:
+            await self.manager.dispatcher.message_handlers.notify(coalesced)
+        except Exception as e:
+            # Задача flush никем не ожидается, поэтому ошибку обработчика нужно записать здесь
+            logger.exception(f"Failed to process coalesced messages from user {user_id}: {e}")
+
+
+class CallbackDedupMiddleware(BaseMiddleware):
+    """
+    Отбрасывает повторные callback-запросы: двойные нажатия и повторно доставленные обновления.
+
+    Ключи - id callback-запроса и (чат, сообщение, версия сообщения, данные кнопки). Недавние ключи
+    хранятся в памяти, а через таблицу processed_callbacks повтор виден и другим процессам бота.
+    Отброшенный callback все равно получает пустой ответ, чтобы у кнопки не зависал индикатор загрузки.
+    """
+
+    CACHE_SIZE = 10000
+    KEEP_DAYS = 1  # сколько хранить ключи в базе
+    PRUNE_INTERVAL = 3600  # секунд между чистками таблицы
+    # Кнопки, которые можно законно нажимать повторно на том же сообщении
+    REPEATABLE_CALLBACKS = ("get_excel_report", "get_funnel_report", "get_activity_report")
+
+    def __init__(self, db: Database, outbound: OutboundScheduler) -> None:
+        super().__init__()
+        self.db = db
+        self.outbound = outbound
+        self.cache: "OrderedDict[str, None]" = OrderedDict()
+        self.last_prune = 0.0
+
+    async def on_pre_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        callback_keys = [f"id:{callback_query.id}"]
+        if callback_query.message and callback_query.data not in self.REPEATABLE_CALLBACKS:
+            # edit_date отличает нажатие той же кнопки после того, как сообщение было отредактировано
+            message = callback_query.message
+            callback_keys.append(f"msg:{message.chat.id}:{message.message_id}:"
+                                 f"{message.edit_date or ''}:{callback_query.data}")
+
+        if any(key in self.cache for key in callback_keys) or not self.db.claim_callback_keys(callback_keys):
+            await self.answer_dropped(callback_query)
+            raise CancelHandler()
+
+        for key in callback_keys:
+            self.cache[key] = None
+        while len(self.cache) > self.CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+        if time.monotonic() - self.last_prune > self.PRUNE_INTERVAL:
+            self.last_prune = time.monotonic()
+            older_than = (datetime.now() - timedelta(days=self.KEEP_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+            self.db.delete_processed_callbacks(older_than)
+
+    async def answer_dropped(self, callback_query: types.CallbackQuery) -> None:
+        try:
+            await self.outbound.call(Priority.INTERACTIVE, None, callback_query.answer)
+        except Exception:
+            # Повторно доставленный callback уже мог получить ответ - это не ошибка
+            pass
@@ -0,0 +1,183 @@
+import asyncio
+import itertools
+import logging
+import time
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram.utils.exceptions import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0  # Ответы пользователям и ответы на callback
+    GROUP = 1  # Уведомления в групповой чат
+    BULK = 2  # Рассылки
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        """Сколько секунд ждать до появления токена (0, если токен уже есть)."""
+        self.refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self) -> None:
+        self.refill()
+        self.tokens -= 1
+
+    def block(self, seconds: float) -> None:
+        """Опустошает корзину так, чтобы следующий токен появился не раньше чем через seconds секунд."""
+        self.refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class OutboundScheduler:
+    """
+    Единая очередь исходящих вызовов Bot API.
+
+    Вызовы выполняются в порядке приоритета (см. Priority) с общим и поканальным ограничением частоты.
+    При RetryAfter на указанное Telegram время приостанавливается только чат, получивший ограничение
+    (или вся отправка, если вызов не привязан к чату), а сам вызов повторяется.
+    """
+
+    GLOBAL_RATE = 30  # вызовов в секунду на бота
+    PRIVATE_CHAT_RATE, PRIVATE_CHAT_BURST = 1, 3  # в секунду на личный чат
+    GROUP_CHAT_RATE, GROUP_CHAT_BURST = 20 / 60, 5  # в секунду на групповой чат
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self) -> None:
+        self.queue: Optional[asyncio.PriorityQueue] = None
+        self.global_bucket = TokenBucket(self.GLOBAL_RATE, self.GLOBAL_RATE)
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.paused_until = 0.0
+        self.counter = itertools.count()
+        self.worker: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self.worker is None:
+            self.queue = asyncio.PriorityQueue()
+            self.worker = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.worker:
+            self.worker.cancel()
+            self.worker = None
+        # Ожидающие в очереди вызовы отменяем, чтобы обработчики не зависли на них при остановке
+        while not self.queue.empty():
+            self.cancel_entry(self.queue.get_nowait())
+
+    async def call(self, priority: Priority, chat_id: Optional[int],
+                   method: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """Ставит вызов method(*args, **kwargs) в очередь и возвращает его результат."""
+        if self.worker is None:
+            raise RuntimeError("Outbound scheduler is not running")
+        future = asyncio.get_event_loop().create_future()
+        self.queue.put_nowait((priority, next(self.counter), (chat_id, method, args, kwargs, future)))
+        return await future
+
+    def submit(self, priority: Priority, chat_id: Optional[int],
+               method: Callable[..., Awaitable[Any]], *args, **kwargs) -> asyncio.Future:
+        """
+        Ставит вызов в очередь без ожидания результата.
+
+        Для уведомлений, которых обработчику не нужно ждать; ошибка вызова только пишется в лог.
+        """
+        if self.worker is None:
+            raise RuntimeError("Outbound scheduler is not running")
+        future = asyncio.get_event_loop().create_future()
+        future.add_done_callback(self.log_failure)
+        self.queue.put_nowait((priority, next(self.counter), (chat_id, method, args, kwargs, future)))
+        return future
+
+    @staticmethod
+    def log_failure(future: asyncio.Future) -> None:
+        if not future.cancelled() and future.exception():
+            logger.error(f"Outbound call failed: {future.exception()}")
+
+    def requeue(self, entry: tuple) -> None:
+        """Возвращает вызов в очередь с прежним приоритетом и порядковым номером."""
+        if self.worker is None:
+            self.cancel_entry(entry)
+        else:
+            self.queue.put_nowait(entry)
+
+    @staticmethod
+    def cancel_entry(entry: tuple) -> None:
+        future = entry[2][4]
+        if not future.done():
+            future.cancel()
+
+    def get_chat_bucket(self, chat_id: int) -> TokenBucket:
+        if chat_id not in self.chat_buckets:
+            if len(self.chat_buckets) >= self.MAX_CHAT_BUCKETS:
+                # Полные корзины ничего не ограничивают - их можно забыть
+                for idle_chat_id in [key for key, bucket in self.chat_buckets.items() if bucket.wait_time() == 0]:
+                    del self.chat_buckets[idle_chat_id]
+            if chat_id < 0:
+                self.chat_buckets[chat_id] = TokenBucket(self.GROUP_CHAT_RATE, self.GROUP_CHAT_BURST)
+            else:
+                self.chat_buckets[chat_id] = TokenBucket(self.PRIVATE_CHAT_RATE, self.PRIVATE_CHAT_BURST)
+        return self.chat_buckets[chat_id]
+
+    async def run(self) -> None:
+        while True:
+            entry = await self.queue.get()
+            chat_id, method, args, kwargs, future = entry[2]
+            if future.cancelled():
+                continue
+
+            # Во время общей паузы по RetryAfter вызов возвращается в очередь, чтобы после нее первыми ушли
+            # самые приоритетные
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                self.requeue(entry)
+                await asyncio.sleep(pause)
+                continue
+
+            # Чат исчерпал лимит - возвращаем вызов в очередь позже, не блокируя остальные чаты.
+            # Порядковый номер сохраняется, поэтому вызовы одного чата не меняются местами.
+            chat_bucket = self.get_chat_bucket(chat_id) if chat_id is not None else None
+            chat_wait = chat_bucket.wait_time() if chat_bucket else 0
+            if chat_wait:
+                asyncio.get_event_loop().call_later(chat_wait, self.requeue, entry)
+                continue
+
+            global_wait = self.global_bucket.wait_time()
+            if global_wait > 0:
+                await asyncio.sleep(global_wait)
+            self.global_bucket.consume()
+            if chat_bucket:
+                chat_bucket.consume()
+
+            asyncio.create_task(self.execute(entry))
+
+    async def execute(self, entry: tuple) -> None:
+        chat_id, method, args, kwargs, future = entry[2]
+        try:
+            result = await method(*args, **kwargs)
+        except RetryAfter as e:
+            if chat_id is not None:
+                logger.warning(f"Flood control: pausing chat {chat_id} for {e.timeout} s")
+                self.get_chat_bucket(chat_id).block(e.timeout)
+            else:
+                logger.warning(f"Flood control: pausing outbound calls for {e.timeout} s")
+                self.paused_until = max(self.paused_until, time.monotonic() + e.timeout)
+            self.requeue(entry)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,53 @@
+"""
+Замер времени импорта и памяти при старте бота.
+
+Запуск: python startup_benchmark.py
+Каждый замер выполняется в отдельном процессе, чтобы модули не брались из кэша.
+"""
+import subprocess
+import sys
+
+MODULES = ["db", "markups", "messages", "pandas", "openpyxl"]
+
+MEASURE_CODE = """
+import sys, time
+
+
+def peak_rss_mb():
+    # psutil дает текущий RSS на любой ОС; без него - пиковый RSS из resource (нет на Windows)
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1024 ** 2
+    except ImportError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss в байтах на macOS и в килобайтах на Linux
+    return max_rss / 1024 ** 2 if sys.platform == "darwin" else max_rss / 1024
+
+
+start = time.perf_counter()
+__import__(sys.argv[1])
+elapsed = time.perf_counter() - start
+rss_mb = peak_rss_mb()
+heavy = [m for m in ("pandas", "openpyxl") if m in sys.modules]
+print(f"{elapsed * 1000:.1f};{'n/a' if rss_mb is None else f'{rss_mb:.1f}'};{','.join(heavy) or '-'}")
+"""
+
+
+def measure(module: str) -> str:
+    result = subprocess.run([sys.executable, "-c", MEASURE_CODE, module],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        return f"{module:<10} ошибка импорта: {result.stderr.strip().splitlines()[-1]}"
+    elapsed_ms, rss_mb, heavy = result.stdout.strip().split(";")
+    return f"{module:<10} {elapsed_ms:>8} мс {rss_mb:>8} МБ  загружены: {heavy}"
+
+
+if __name__ == "__main__":
+    print(f"{'модуль':<10} {'время':>11} {'RSS':>11}")
+    for module_name in MODULES:
+        print(measure(module_name))
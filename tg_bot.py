@@ -1,7 +1,14 @@
+import asyncio
+import re
+import time
+from datetime import datetime, timedelta
 from aiogram import Bot, Dispatcher, types
 from aiogram.utils import executor
 from auth_data import bot_token, group_chat_id
 from db import Database
+from outbound import OutboundScheduler, Priority
+from middlewares import AntiFloodMiddleware, CallbackDedupMiddleware
+import backlog
 import logging
 import messages as msg
 import markups
@@ -10,13 +17,18 @@ from aiogram.dispatcher.filters.state import StatesGroup, State
 from aiogram.dispatcher import FSMContext
 from aiogram.types.input_file import InputFile
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
-from aiogram.utils.exceptions import BotBlocked
+from aiogram.utils.exceptions import BotBlocked, BadRequest, InvalidQueryID
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+BROADCAST_PROGRESS_INTERVAL = 5  # секунд между обновлениями статуса рассылки
+SEARCH_COMMAND = re.compile(r"^поиск(\s|$)", re.IGNORECASE)
+BROADCAST_SEGMENTS = ("send_to_all", "send_to_incomplete", "send_to_completed", "send_to_schengen", "send_to_recent")
+
 bot = Bot(token=bot_token)
 dp = Dispatcher(bot, storage=MemoryStorage())
+outbound = OutboundScheduler()
 db = Database("database.db")
 db.initialize_database()
 
@@ -47,15 +59,28 @@ class BulkSendConfirmation(StatesGroup):
 dp.filters_factory.bind(ChatIdFilter)
 dp.filters_factory.bind(PrivateChatOnly)
 
+anti_flood = AntiFloodMiddleware()
+dp.middleware.setup(anti_flood)
+dp.middleware.setup(CallbackDedupMiddleware(db, outbound))
+
+
+async def answer_callback(callback_query: types.CallbackQuery):
+    """Отвечает на callback, если это еще возможно: нажатия, пришедшие пока бот был выключен, устаревают."""
+    try:
+        await outbound.call(Priority.INTERACTIVE, None, bot.answer_callback_query, callback_query.id)
+    except (InvalidQueryID, BadRequest) as e:
+        logger.info(f"Callback {callback_query.id} was not answered: {e}")
+
 
 @dp.message_handler(lambda message: message.text.strip().lower().replace(" ", "") in ["отчет", "jnxtn"],
                     chat_id=group_chat_id)
 async def send_report(message: types.Message):
-    report = db.get_report()
-    await bot.send_message(group_chat_id,
-                           report,
-                           reply_to_message_id=message.message_id,
-                           reply_markup=markups.report_keyboard)
+    report = db.get_report() + msg.anti_flood_report_msg(anti_flood.counters)
+    await outbound.call(Priority.INTERACTIVE, group_chat_id,
+                        bot.send_message, group_chat_id,
+                        report,
+                        reply_to_message_id=message.message_id,
+                        reply_markup=markups.report_keyboard)
 
 
 @dp.message_handler(lambda message: message.text.startswith("@"), chat_id=group_chat_id)
@@ -68,9 +93,30 @@ async def handle_user_info_request(message: types.Message):
         # Разбиваем сообщение на части, если оно слишком длинное
         for i in range(0, len(user_info_msg), 4096):
             chunk = user_info_msg[i:i + 4096]
-            await bot.send_message(group_chat_id, chunk)
+            await outbound.call(Priority.INTERACTIVE, group_chat_id, bot.send_message, group_chat_id, chunk)
     else:
-        await bot.send_message(group_chat_id, f"Пользователь с никнеймом @{username} не найден.")
+        await outbound.call(Priority.INTERACTIVE, group_chat_id,
+                            bot.send_message, group_chat_id, f"Пользователь с никнеймом @{username} не найден.")
+
+
+@dp.message_handler(lambda message: message.text and SEARCH_COMMAND.match(message.text), chat_id=group_chat_id)
+async def handle_answers_search(message: types.Message):
+    terms = message.text[len("поиск"):].strip()
+    if not terms:
+        # Без этого ответа пустой запрос ушел бы в предложение рассылки
+        await outbound.call(Priority.INTERACTIVE, group_chat_id,
+                            bot.send_message, group_chat_id, msg.search_usage_msg,
+                            reply_to_message_id=message.message_id)
+        return
+
+    search_msg = msg.search_results_msg(terms, db.search_answers(terms))
+
+    # Разбиваем сообщение на части, если оно слишком длинное
+    for i in range(0, len(search_msg), 4096):
+        chunk = search_msg[i:i + 4096]
+        await outbound.call(Priority.INTERACTIVE, group_chat_id,
+                            bot.send_message, group_chat_id, chunk,
+                            reply_to_message_id=message.message_id)
 
 
 @dp.message_handler(chat_id=group_chat_id)
@@ -78,38 +124,41 @@ async def handle_manager_reply(message: types.Message, state: FSMContext):
     # Сохраняем текст сообщения в state
     await state.set_data({"message_text": message.text})
 
-    await bot.send_message(message.chat.id,
-                           msg.send_to_all_question,
-                           reply_markup=markups.send_to_all_keyboard,
-                           reply_to_message_id=message.message_id)
+    await outbound.call(Priority.INTERACTIVE, message.chat.id,
+                        bot.send_message, message.chat.id,
+                        msg.send_to_all_question,
+                        reply_markup=markups.send_to_all_keyboard,
+                        reply_to_message_id=message.message_id)
     await BulkSendConfirmation.confirm.set()
 
 
 @dp.message_handler(PrivateChatOnly(), commands=['start'])
 async def start(message: types.Message):
-    user_id = db.generate_unique_user_id('telegram', message.from_user.id)
-    is_user_exists = db.get_row_as_dict({'user_id': user_id}, ['users'])
+    is_user_exists = db.get_user('telegram', message.from_user.id)
 
     user_data = db.create_and_update_user(message, 'telegram')
     if not is_user_exists:
-        await message.answer(msg.start_message(user_data), parse_mode='HTML')
-        await bot.send_message(group_chat_id, f"🆕 У нас новый пользователь!🆕\n@{message.from_user.username}")
+        await outbound.call(Priority.INTERACTIVE, message.chat.id,
+                            message.answer, msg.start_message(user_data), parse_mode='HTML')
+        outbound.submit(Priority.GROUP, group_chat_id,
+                        bot.send_message, group_chat_id,
+                        f"🆕 У нас новый пользователь!🆕\n@{message.from_user.username}")
     if user_data.get('start_message_id'):
         await update_message(message.chat.id, user_data['start_message_id'])
 
     current_step = user_data['progress']
     current_script_item = msg.script_data.get(current_step)
 
-    start_message = await message.answer(msg.generate_message_text(current_script_item, user_data),
-                                         reply_markup=markups.generate_keyboard(user_data["progress"]),
-                                         parse_mode='HTML')
+    start_message = await outbound.call(Priority.INTERACTIVE, message.chat.id,
+                                        message.answer, msg.generate_message_text(current_script_item, user_data),
+                                        reply_markup=markups.generate_keyboard(user_data["progress"]),
+                                        parse_mode='HTML')
     db.update_table("users", {"start_message_id": start_message.message_id}, {"user_id": user_data["user_id"]})
 
 
 @dp.message_handler(PrivateChatOnly())
 async def handle_message(message: types.Message):
-    user_id = db.generate_unique_user_id('telegram', message.from_user.id)
-    user_data = db.get_row_as_dict({'user_id': user_id}, ['users'])
+    user_data = db.get_user('telegram', message.from_user.id)
 
     # Получаем текущий шаг пользователя
     current_step = user_data['progress']
@@ -134,25 +183,29 @@ async def handle_message(message: types.Message):
         current_keyboard = markups.generate_keyboard(current_step)
 
     # Отправка нового сообщения
-    start_message = await message.answer(text=current_message_text,
-                                         reply_markup=current_keyboard,
-                                         parse_mode='HTML')
+    start_message = await outbound.call(Priority.INTERACTIVE, message.chat.id,
+                                        message.answer, text=current_message_text,
+                                        reply_markup=current_keyboard,
+                                        parse_mode='HTML')
     db.update_table("users", {"start_message_id": start_message.message_id,
-                              "progress": current_step},
+                              "progress": current_step,
+                              "is_active": 1},
                     {"user_id": user_data["user_id"]})
 
     if current_step == 0:
-        await bot.send_message(group_chat_id, f"🟢 Пользователь завершил опрос!🟢\n@{message.from_user.username}")
+        outbound.submit(Priority.GROUP, group_chat_id,
+                        bot.send_message, group_chat_id,
+                        f"🟢 Пользователь завершил опрос!🟢\n@{message.from_user.username}")
     elif current_step == -2:
-        await bot.send_message(group_chat_id,
-                               f"❓ Пользователь задает вопрос! ❓\n@{message.from_user.username}")
+        outbound.submit(Priority.GROUP, group_chat_id,
+                        bot.send_message, group_chat_id,
+                        f"❓ Пользователь задает вопрос! ❓\n@{message.from_user.username}")
 
 
 @dp.callback_query_handler(lambda c: c.data in ["yes", "no", "russia", "go_to_manager", "no_go_to_manager"])
 async def handle_answer(callback_query: types.CallbackQuery):
-    await bot.answer_callback_query(callback_query.id)
-    user_id = db.generate_unique_user_id('telegram', callback_query.from_user.id)
-    user_data = db.get_row_as_dict({'user_id': user_id}, ['users'])
+    await answer_callback(callback_query)
+    user_data = db.get_user('telegram', callback_query.from_user.id)
 
     # Получаем текущий шаг пользователя
     current_step = user_data['progress']
@@ -165,7 +218,7 @@ async def handle_answer(callback_query: types.CallbackQuery):
     # Обновление прогресса пользователя
     next_step = current_script_item['actions'].get(callback_query.data)
     if next_step is not None:
-        db.update_user_progress(user_id, next_step)
+        db.update_user_progress(user_data['user_id'], next_step)
 
     # Обновление предыдущего сообщения с добавлением ответа или удалением клавиатуры
     answer_text = markups.inline_button_texts.get(callback_query.data)
@@ -177,22 +230,24 @@ async def handle_answer(callback_query: types.CallbackQuery):
     # Отправка сообщения следующего шага
     next_script_item = msg.script_data.get(next_step)
     next_message_text = msg.generate_message_text(next_script_item, user_data)
-    start_message = await bot.send_message(chat_id=callback_query.message.chat.id,
-                                           text=next_message_text,
-                                           reply_markup=markups.generate_keyboard(next_step),
-                                           parse_mode='HTML')
+    start_message = await outbound.call(Priority.INTERACTIVE, callback_query.message.chat.id,
+                                        bot.send_message, chat_id=callback_query.message.chat.id,
+                                        text=next_message_text,
+                                        reply_markup=markups.generate_keyboard(next_step),
+                                        parse_mode='HTML')
 
     db.update_table("users", {"start_message_id": start_message.message_id}, {"user_id": user_data["user_id"]})
 
     if next_step < 1:
-        await bot.send_message(group_chat_id, f"🟢 Пользователь завершил опрос!🟢\n@{callback_query.from_user.username}")
+        outbound.submit(Priority.GROUP, group_chat_id,
+                        bot.send_message, group_chat_id,
+                        f"🟢 Пользователь завершил опрос!🟢\n@{callback_query.from_user.username}")
 
 
 @dp.callback_query_handler(lambda c: c.data == "other")
 async def handle_other(callback_query: types.CallbackQuery):
-    await bot.answer_callback_query(callback_query.id)
-    user_id = db.generate_unique_user_id('telegram', callback_query.from_user.id)
-    user_data = db.get_row_as_dict({'user_id': user_id}, ['users'])
+    await answer_callback(callback_query)
+    user_data = db.get_user('telegram', callback_query.from_user.id)
 
     # Получаем текущий шаг пользователя
     current_step = user_data['progress']
@@ -201,13 +256,15 @@ async def handle_other(callback_query: types.CallbackQuery):
     # Обновление прогресса пользователя
     next_step = current_script_item['actions'].get(callback_query.data)
     if next_step is not None:
-        db.update_user_progress(user_id, next_step)
+        db.update_user_progress(user_data['user_id'], next_step)
 
     # Обновление сообщения следующего шага
     next_script_item = msg.script_data.get(next_step)
     next_message_text = msg.generate_message_text(next_script_item, user_data)
 
-    await bot.edit_message_text(
+    await outbound.call(
+        Priority.INTERACTIVE, callback_query.message.chat.id,
+        bot.edit_message_text,
         chat_id=callback_query.message.chat.id,
         message_id=user_data.get('start_message_id'),
         text=next_message_text,
@@ -218,20 +275,21 @@ async def handle_other(callback_query: types.CallbackQuery):
 
 @dp.callback_query_handler(lambda c: c.data in ("back_to_survey", "go_back"))
 async def handle_back_to_survey(callback_query: types.CallbackQuery):
-    await bot.answer_callback_query(callback_query.id)
-    user_id = db.generate_unique_user_id('telegram', callback_query.from_user.id)
-    user_data = db.get_row_as_dict({'user_id': user_id}, ['users'])
+    await answer_callback(callback_query)
+    user_data = db.get_user('telegram', callback_query.from_user.id)
 
     # Получаем текущий шаг пользователя
     current_step = user_data['progress']
     if callback_query.data == "go_back":
         current_step = max(current_step - 1, 0)
-        db.update_user_progress(user_id, current_step)
+        db.update_user_progress(user_data['user_id'], current_step)
 
     current_script_item = msg.script_data.get(current_step)
     current_message_text = msg.generate_message_text(current_script_item, user_data)
 
-    await bot.edit_message_text(
+    await outbound.call(
+        Priority.INTERACTIVE, callback_query.message.chat.id,
+        bot.edit_message_text,
         chat_id=callback_query.message.chat.id,
         message_id=user_data.get('start_message_id'),
         text=current_message_text,
@@ -242,71 +300,142 @@ async def handle_back_to_survey(callback_query: types.CallbackQuery):
 
 @dp.callback_query_handler(text="get_excel_report")
 async def on_get_excel_report_clicked(query: types.CallbackQuery):
-    await bot.answer_callback_query(query.id)
-    excel_report = db.create_excel_report()
-    await bot.send_document(group_chat_id, InputFile(*excel_report))
-
-
-@dp.callback_query_handler(lambda c: c.data == 'send_to_all', state=BulkSendConfirmation.confirm)
+    await answer_callback(query)
+    # Снимок базы и сборка файла занимают время, поэтому выполняются вне event loop
+    excel_report = await asyncio.get_event_loop().run_in_executor(None, db.create_excel_report)
+    await outbound.call(Priority.INTERACTIVE, group_chat_id,
+                        bot.send_document, group_chat_id, InputFile(*excel_report))
+
+
+@dp.callback_query_handler(text="get_funnel_report")
+async def on_get_funnel_report_clicked(query: types.CallbackQuery):
+    await answer_callback(query)
+    await outbound.call(Priority.INTERACTIVE, group_chat_id,
+                        bot.send_message, group_chat_id, db.get_funnel_report())
+
+
+@dp.callback_query_handler(text="get_activity_report")
+async def on_get_activity_report_clicked(query: types.CallbackQuery):
+    await answer_callback(query)
+    await outbound.call(Priority.INTERACTIVE, group_chat_id,
+                        bot.send_message, group_chat_id, db.get_activity_report())
+
+
+def get_audience_filters(segment: str) -> dict:
+    """Фильтры аудитории рассылки для кнопки сегмента (см. Database.build_audience_query)."""
+    audience_filters = {
+        "send_to_all": {"is_active": 1},
+        "send_to_incomplete": {"is_active": 1, "completed": False},
+        "send_to_completed": {"is_active": 1, "completed": True},
+        "send_to_schengen": {"is_active": 1, "answers": {2: "yes"}},
+        "send_to_recent": {"is_active": 1,
+                           "last_activity": ((datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d %H:%M:%S"),
+                                             None)},
+    }
+    return audience_filters[segment]
+
+
+@dp.callback_query_handler(lambda c: c.data in BROADCAST_SEGMENTS, state=BulkSendConfirmation.confirm)
 async def on_send_to_all_clicked(callback_query: types.CallbackQuery, state: FSMContext):
-    await bot.answer_callback_query(callback_query.id)
+    await answer_callback(callback_query)
     user_data = await state.get_data()
     message_text = user_data.get("message_text", "")
     await state.finish()
 
-    successful_sends = 0
-    blocked_users_count = 0
-
-    # Получаем список ID пользователей Telegram
-    all_users_id = db.get_all_users_id("telegram")
-
-    for user_id in all_users_id:
-        try:
-            # Отправка сообщения по числовому ID пользователя
-            telegram_user_id = int(user_id.split('_')[1])
-            await bot.send_message(telegram_user_id, message_text)
-            db.update_table('users', {'is_active': 1}, {'user_id': user_id})
-            successful_sends += 1
-        except BotBlocked:
-            db.update_table('users', {'is_active': 0}, {'user_id': user_id})
-            blocked_users_count += 1
-        except Exception as e:
-            print(f"Ошибка при отправке сообщения: {e}")
-
-    report_msg = msg.bulk_send_report_msg(len(all_users_id), successful_sends, blocked_users_count, success=True)
-    await bot.edit_message_text(chat_id=group_chat_id,
-                                message_id=callback_query.message.message_id,
-                                text=report_msg,
-                                reply_markup=None, parse_mode='HTML')
+    # Сохраняем рассылку как задание с получателями выбранного сегмента
+    job_id = db.create_broadcast_job(message_text, get_audience_filters(callback_query.data),
+                                     callback_query.message.message_id)
+    await run_broadcast_job(job_id)
+
+
+async def run_broadcast_job(job_id: int):
+    """Отправляет сообщение оставшимся получателям задания, отмечая результат каждой отправки."""
+    job = db.get_row_as_dict({'job_id': job_id}, 'broadcasts')
+    await update_broadcast_status(job, msg.bulk_send_progress_msg(db.get_broadcast_progress(job_id)))
+    last_progress_edit = time.monotonic()
+
+    for is_retry in (False, True):
+        # Ошибки отправки часто временные, поэтому неудачные отправки повторяются один раз
+        if is_retry and not db.retry_failed_broadcast_recipients(job_id):
+            break
+
+        for user_id, chat_id in db.iter_pending_recipients(job_id):
+            try:
+                # Отправка сообщения по числовому ID пользователя
+                await outbound.call(Priority.BULK, chat_id, bot.send_message, chat_id, job['message_text'])
+                db.mark_broadcast_recipient(job_id, user_id, 'sent')
+            except BotBlocked:
+                db.mark_broadcast_recipient(job_id, user_id, 'blocked')
+            except Exception as e:
+                db.mark_broadcast_recipient(job_id, user_id, 'failed')
+                print(f"Ошибка при отправке сообщения: {e}")
+
+            # Прогресс в групповом чате обновляется не чаще раза в BROADCAST_PROGRESS_INTERVAL секунд
+            if time.monotonic() - last_progress_edit >= BROADCAST_PROGRESS_INTERVAL:
+                await update_broadcast_status(job, msg.bulk_send_progress_msg(db.get_broadcast_progress(job_id)))
+                last_progress_edit = time.monotonic()
+
+    db.finish_broadcast_job(job_id)
+    progress = db.get_broadcast_progress(job_id)
+    report_msg = msg.bulk_send_report_msg(progress['total'], progress['sent'], progress['blocked'], progress['failed'],
+                                          success=True)
+    await update_broadcast_status(job, report_msg)
+
+
+async def update_broadcast_status(job: dict, text: str):
+    try:
+        await outbound.call(Priority.GROUP, group_chat_id,
+                            bot.edit_message_text, chat_id=group_chat_id,
+                            message_id=job['status_message_id'],
+                            text=text,
+                            reply_markup=None, parse_mode='HTML')
+    except Exception as e:
+        print(f"Ошибка при обновлении статуса рассылки: {e}")
 
 
 @dp.callback_query_handler(lambda c: c.data == 'do_not_send_to_all', state=BulkSendConfirmation.confirm)
 async def process_callback_cancel(callback_query: types.CallbackQuery, state: FSMContext):
-    await bot.answer_callback_query(callback_query.id)
+    await answer_callback(callback_query)
     await state.finish()
-    await bot.edit_message_text(chat_id=group_chat_id,
-                                message_id=callback_query.message.message_id,
-                                text=msg.bulk_send_report_msg(),
-                                reply_markup=None, parse_mode='HTML')
+    await outbound.call(Priority.INTERACTIVE, group_chat_id,
+                        bot.edit_message_text, chat_id=group_chat_id,
+                        message_id=callback_query.message.message_id,
+                        text=msg.bulk_send_report_msg(),
+                        reply_markup=None, parse_mode='HTML')
 
 
 async def update_message(chat_id, message_id, original_text=None, answer_text=None):
     try:
         if original_text and answer_text:
             # Если предоставлен текст ответа, добавляем его к сообщению
-            await bot.edit_message_text(chat_id=chat_id, message_id=message_id,
-                                        text=f"{original_text}\n\n→ {answer_text}",
-                                        reply_markup=None, parse_mode='HTML')
+            await outbound.call(Priority.INTERACTIVE, chat_id,
+                                bot.edit_message_text, chat_id=chat_id, message_id=message_id,
+                                text=f"{original_text}\n\n→ {answer_text}",
+                                reply_markup=None, parse_mode='HTML')
         else:
             # Если текст ответа не предоставлен, удаляем только клавиатуру
-            await bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id)
+            await outbound.call(Priority.INTERACTIVE, chat_id,
+                                bot.edit_message_reply_markup, chat_id=chat_id, message_id=message_id)
     except Exception as e:
         print(f"Ошибка при обновлении сообщения: {e}")
 
 
+async def on_startup(*args):  # noqa
+    outbound.start()
+
+    # Продолжаем рассылки, прерванные перезапуском, с места остановки
+    for job in db.get_unfinished_broadcast_jobs():
+        logger.info(f"Resuming broadcast job {job['job_id']}")
+        asyncio.create_task(run_broadcast_job(job['job_id']))
+
+    # Обрабатываем сообщения, пришедшие пока бот был выключен, и только потом запускаем обычный polling
+    await backlog.catch_up(dp)
+
+
 async def on_shutdown(*args):  # noqa
+    await outbound.stop()
     db.close()
 
 
 if __name__ == "__main__":
-    executor.start_polling(dp, skip_updates=True, on_shutdown=on_shutdown)
+    executor.start_polling(dp, skip_updates=False, on_startup=on_startup, on_shutdown=on_shutdown)